@@ -1,4 +1,5 @@
 import os
+import math
 import time
 import datetime
 import numpy as np
@@ -6,150 +7,257 @@ import jwt
 import requests
 import argparse
 import xarray as xr
-import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None  # optional, the derived quantities fall back to plain numpy without it
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # optional, orjson just decodes the API responses faster
 
 """
 In this section, we define the helper functions to access the WindBorne API
 This is described in https://windbornesystems.com/docs/api
 """
 
+# A signed token is reused for consecutive requests until it is this many seconds old
+TOKEN_REUSE_SECONDS = 240
+_token_cache = None  # (client_id, iat, signed token) of the most recently signed token
+
 
-def wb_get_request(url):
+def wb_signed_token(client_id, api_key):
     """
-    Make a GET request to WindBorne, authorizing with WindBorne correctly
+    Create a signed JSON Web Token for authentication, reusing the previous one if it is still fresh
     """
+    global _token_cache
 
-    client_id = os.environ['WB_CLIENT_ID']  # Make sure to set this!
-    api_key = os.environ['WB_API_KEY']  # Make sure to set this!
+    now = int(time.time())
+    if _token_cache is not None and _token_cache[0] == client_id and now - _token_cache[1] < TOKEN_REUSE_SECONDS:
+        return _token_cache[2]
 
-    # create a signed JSON Web Token for authentication
     # this token is safe to pass to other processes or servers if desired, as it does not expose the API key
     signed_token = jwt.encode({
         'client_id': client_id,
-        'iat': int(time.time()),
+        'iat': now,
     }, api_key, algorithm='HS256')
 
+    _token_cache = (client_id, now, signed_token)
+    return signed_token
+
+
+def wb_get_request(url, session=None):
+    """
+    Make a GET request to WindBorne, authorizing with WindBorne correctly
+    Pass a requests.Session to reuse its connection across requests
+    """
+
+    client_id = os.environ['WB_CLIENT_ID']  # Make sure to set this!
+    api_key = os.environ['WB_API_KEY']  # Make sure to set this!
+
+    signed_token = wb_signed_token(client_id, api_key)
+
     # make the request, checking the status code to make sure it succeeded
-    response = requests.get(url, auth=(client_id, signed_token))
+    response = (session or requests).get(url, auth=(client_id, signed_token))
     response.raise_for_status()
 
-    # return the response body
-    return response.json()
+    # return the decoded response body
+    return json_loads(response.content)
+
+
+def with_query_params(url, params):
+    """
+    Return the url with the given query parameters set, replacing any values it already has for them
+    Other parameters are kept as they are, including repeated ones
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key not in params]
+    query.extend(params.items())
+    return urlunsplit(parts._replace(query=urlencode(query)))
 
 """
 In this section, we have the core functions to convert data to netcdf
 """
-def convert_to_netcdf(data, mission_name, curtime, bucket_hours ):
+
+# Observation fields carried through to the netcdf output, either directly or via derived quantities.
+# Each is numeric, and they are collected as the columns of a float64 array as pages come in.
+# Any other field the API returns (eg id and mission_id) is not written to the netcdf files.
+OBSERVATION_FIELDS = ('timestamp', 'latitude', 'longitude', 'altitude', 'temperature', 'pressure',
+                      'specific_humidity', 'speed_u', 'speed_v')
+
+# Mapping of WindBorne names to ISARRA names
+ISARRA_NAMES = {
+    'latitude' : 'lat',
+    'longitude' : 'lon',
+    'altitude' : 'altitude',
+    'temperature' : 'air_temperature',
+    'wind_direction' : 'wind_direction',
+    'wind_speed' : 'wind_speed',
+    'pressure' : 'air_pressure',
+    'humidity_mixing_ratio' : 'humidity_mixing_ratio',
+}
+
+# Attributes of each variable in the netcdf output, by ISARRA name
+VAR_ATTRS = {
+    'time': {'units': 'seconds since 1970-01-01T00:00:00', 'long_name': 'Time', 'processing_level': ''},
+    'lat': {'units': 'degrees_north', 'long_name': 'Latitude', 'processing_level': ''},
+    'lon': {'units': 'degrees_east', 'long_name': 'Longitude', 'processing_level': ''},
+    'altitude': {'units': 'meters_above_sea_level', 'long_name': 'Altitude', 'processing_level': ''},
+    'air_temperature': {'units': 'Kelvin', 'long_name': 'Air Temperature', 'processing_level': ''},
+    'wind_speed': {'units': 'm/s', 'long_name': 'Wind Speed', 'processing_level': ''},
+    'wind_direction': {'units': 'degrees', 'long_name': 'Wind Direction', 'processing_level': ''},
+    'humidity_mixing_ratio': {'units': 'kg/kg', 'long_name': 'Humidity Mixing Ratio', 'processing_level': ''},
+    'air_pressure': {'units': 'Pa', 'long_name': 'Atmospheric Pressure', 'processing_level': ''},
+}
+
+GLOBAL_ATTRS = {
+    # Global Attributes synonymous across all UASDC providers
+    'Conventions': "CF-1.8, WMO-CF-1.0",
+    'wmo__cf_profile': "FM 303-2024",
+    'featureType': "trajectory",
+
+    # Global Attributes unique to Provider (plus the flight_id, which is set per file)
+    'platform_name': "WindBorne Global Sounding Balloon",
+    'site_terrain_elevation_height': 'not applicable',
+    'processing_level': "b1",
+}
+
+# netcdf encoding of the floating point variables: uncompressed, with NaN marking missing values.
+#    The chunk size depends on the number of observations, so is added per file
+VAR_ENCODING = {var: {'zlib': False, '_FillValue': np.nan} for var in VAR_ATTRS}
+
+def convert_to_netcdf(data, mission_name, curtime, bucket_hours, bucket_index=None):
     # This module outputs data in netcdf format for the WMO ISARRA program.  The output format is netcdf
     #   and the style (variable names, file names, etc.) are described here:
     #  https://github.com/synoptic/wmo-uasdc/tree/main/raw_uas_to_netCDF
 
-    # Mapping of WindBorne names to ISARRA names
-    rename_dict = {
-        'latitude' : 'lat',
-        'longitude' : 'lon',
-        'altitude' : 'altitude',
-        'temperature' : 'air_temperature',
-        'wind_direction' : 'wind_direction',
-        'wind_speed' : 'wind_speed',
-        'pressure' : 'air_pressure',
-        'humidity_mixing_ratio' : 'humidity_mixing_ratio',
-        'index' : 'obs',
-    }
-
-    # Put the data in a panda datafram in order to easily push to xarray then netcdf output
-    df = pd.DataFrame(data)
-    ds = xr.Dataset.from_dataframe(df)
-
     # Build the filename and save some variables for use later
     mt = datetime.datetime.fromtimestamp(curtime, tz=datetime.timezone.utc)
     outdatestring = mt.strftime('%Y%m%d%H%M%S')
-    mission_name = ds['mission_name'].data[0]
     output_file = 'WindBorne_W-{}_{}Z.nc'.format(mission_name[2:6],outdatestring)
 
     # Derived quantities calculated here:
 
     # convert from specific humidity to humidity_mixing_ratio
     mg_to_kg = 1000000.
-    if not all(x is None for x in ds['specific_humidity'].data):
-        ds['humidity_mixing_ratio'] = (ds['specific_humidity'] / mg_to_kg) / (1 - (ds['specific_humidity'] / mg_to_kg))
+    sh = data['specific_humidity']
+    if not np.isnan(sh).all():
+        if ne is not None:
+            mixing_ratio = ne.evaluate('(sh / mg_to_kg) / (1 - sh / mg_to_kg)',
+                                       local_dict={'sh': sh, 'mg_to_kg': mg_to_kg})
+        else:
+            mixing_ratio = (sh / mg_to_kg) / (1 - sh / mg_to_kg)
     else:
-        ds['humidity_mixing_ratio'] = ds['specific_humidity']
+        mixing_ratio = sh
 
     # Wind speed and direction from components
-    ds['wind_speed'] = np.sqrt(ds['speed_u']*ds['speed_u'] + ds['speed_v']*ds['speed_v'])
-    ds['wind_direction'] = np.mod(180 + (180 / np.pi) * np.arctan2(ds['speed_u'], ds['speed_v']), 360)
-
-    ds['time'] = ds['timestamp'].astype(float)
-    ds = ds.assign_coords(time=("time", ds['time'].data))
-
-    # Now that calculations are done, remove variables not needed in the netcdf output
-    ds = ds.drop_vars(['humidity', 'speed_u', 'speed_v', 'specific_humidity',
-                       'timestamp', 'mission_name'])
-
-    # Rename the variables
-    ds = ds.rename(rename_dict)
-
-    # Adding attributes to variables in the xarray dataset
-    ds['time'].attrs = {'units': 'seconds since 1970-01-01T00:00:00', 'long_name': 'Time', '_FillValue': float('nan'),
-                        'processing_level': ''}
-    ds['lat'].attrs = {'units': 'degrees_north', 'long_name': 'Latitude', '_FillValue': float('nan'),
-                       'processing_level': ''}
-    ds['lon'].attrs = {'units': 'degrees_east', 'long_name': 'Longitude', '_FillValue': float('nan'),
-                       'processing_level': ''}
-    ds['altitude'].attrs = {'units': 'meters_above_sea_level', 'long_name': 'Altitude', '_FillValue': float('nan'),
-                            'processing_level': ''}
-    ds['air_temperature'].attrs = {'units': 'Kelvin', 'long_name': 'Air Temperature', '_FillValue': float('nan'),
-                                   'processing_level': ''}
-    ds['wind_speed'].attrs = {'units': 'm/s', 'long_name': 'Wind Speed', '_FillValue': float('nan'),
-                              'processing_level': ''}
-    ds['wind_direction'].attrs = {'units': 'degrees', 'long_name': 'Wind Direction', '_FillValue': float('nan'),
-                                  'processing_level': ''}
-    ds['humidity_mixing_ratio'].attrs = {'units': 'kg/kg', 'long_name': 'Humidity Mixing Ratio',
-                                         '_FillValue': float('nan'), 'processing_level': ''}
-    ds['air_pressure'].attrs = {'units': 'Pa', 'long_name': 'Atmospheric Pressure', '_FillValue': float('nan'),
-                                'processing_level': ''}
-
-    # Add Global Attributes synonymous across all UASDC providers
-    ds.attrs['Conventions'] = "CF-1.8, WMO-CF-1.0"
-    ds.attrs['wmo__cf_profile'] = "FM 303-2024"
-    ds.attrs['featureType'] = "trajectory"
-
-    # Add Global Attributes unique to Provider
-    ds.attrs['platform_name'] = "WindBorne Global Sounding Balloon"
-    ds.attrs['flight_id'] = mission_name
-    ds.attrs['site_terrain_elevation_height'] = 'not applicable'
-    ds.attrs['processing_level'] = "b1"
-    ds.to_netcdf(output_file)
-
-def output_data(accumulated_observations, mission_name, starttime, bucket_hours):
-    accumulated_observations.sort(key=lambda x: x['timestamp'])
+    # These work on the raw arrays, in place, to avoid a temporary for every step of the formulas
+    u = data['speed_u']
+    v = data['speed_v']
+
+    wind_speed = np.empty_like(u)
+    np.hypot(u, v, out=wind_speed)
+
+    if ne is not None:
+        wind_direction = ne.evaluate('(180 + (180 / pi) * arctan2(u, v)) % 360',
+                                     local_dict={'u': u, 'v': v, 'pi': np.pi})
+    else:
+        wind_direction = np.empty_like(u)
+        np.arctan2(u, v, out=wind_direction)
+        wind_direction *= 180 / np.pi
+        wind_direction += 180
+        np.mod(wind_direction, 360, out=wind_direction)
+
+    values = dict(data, humidity_mixing_ratio=mixing_ratio, wind_speed=wind_speed, wind_direction=wind_direction)
+
+    # Build the dataset in one go, with every variable already under its ISARRA name and carrying its
+    #    attributes. The time coordinate runs along obs, like every other variable
+    ds = xr.Dataset(
+        {isarra_name: xr.Variable(('obs',), values[name], VAR_ATTRS[isarra_name])
+         for name, isarra_name in ISARRA_NAMES.items()},
+        coords={'time': xr.Variable(('obs',), data['timestamp'], VAR_ATTRS['time'])},
+        attrs=dict(GLOBAL_ATTRS, flight_id=mission_name),
+    )
+
+    # Each variable is small enough to be written as a single chunk
+    chunksizes = (ds.sizes['obs'],)
+    encoding = {var: dict(var_encoding, chunksizes=chunksizes) for var, var_encoding in VAR_ENCODING.items()}
+
+    # When several buckets share a file, tag each observation with the bucket it falls in
+    if bucket_index is not None:
+        ds = ds.assign_coords(bucket_index=xr.Variable(('obs',), bucket_index, attrs={
+            'long_name': 'Time Bucket Index',
+            'comment': f'Index of the {bucket_hours:g} hour bucket, counted from the time in the file name'}))
+        encoding['bucket_index'] = {'zlib': False, 'chunksizes': chunksizes}
+
+    ds.to_netcdf(output_file, engine='h5netcdf', encoding=encoding)
+
+def output_data(observations, mission_name, starttime, bucket_hours, split_files=False, writer=None):
+    # Files are written by submitting them to the writer executor if one is given, returning the futures
+    #    of the writes. Without one, they are written here, one after another
+
+    # Put every field in time order. The API usually returns observations in order already, in which
+    #    case there is nothing to reorder
+    timestamps = observations['timestamp']
+    if np.any(timestamps[1:] < timestamps[:-1]):
+        order = np.argsort(timestamps, kind='stable')
+        observations = {field: values[order] for field, values in observations.items()}
+        timestamps = observations['timestamp']
 
     # Here, set the earliest time of data to be the first observation time, then set it to the most recent
     #    start of a bucket increment.
     # The reason to do this rather than using the input starttime, is because sometimes the data
     #    doesn't start at the start time, and the underlying output would try to output data that doesn't exist
     #
-    accumulated_observations.sort(key=lambda x: x['timestamp'])
-    earliest_time = accumulated_observations[0]['timestamp']
+    earliest_time = timestamps[0]
     if (earliest_time < starttime):
         print("Something is wrong: how can we have gotten data from before the starttime?")
-    curtime = earliest_time - earliest_time % (bucket_hours * 60 * 60)
-
-    start_index = 0
-    for i in range(len(accumulated_observations)):
-        if accumulated_observations[i]['timestamp'] - curtime > bucket_hours * 60 * 60:
-            segment = accumulated_observations[start_index:i]
-            print(f"Converting {len(segment)} observation(s) and saving as netcdf")
-            convert_to_netcdf(segment, mission_name, curtime, bucket_hours)
-
-            start_index = i
-            curtime += datetime.timedelta(hours=bucket_hours).seconds
-
-    # Cover any extra data within the latest partial bucket
-    segment = accumulated_observations[start_index:]
-    print(f"Converting {len(segment)} observation(s) and saving as netcdf")
-    convert_to_netcdf(segment, mission_name, curtime, bucket_hours)
+    # Rounded rather than truncated, as eg 1.13 hours comes out just under 4068 seconds in floating point
+    bucket_seconds = round(bucket_hours * 60 * 60)
+    first_bucket = earliest_time - earliest_time % bucket_seconds
+
+    # Find where each bucket ends in the sorted timestamps in one go. An observation exactly on a
+    #    bucket edge belongs to the bucket ending there
+    bucket_ends = np.arange(first_bucket + bucket_seconds, timestamps[-1] + bucket_seconds, bucket_seconds)
+
+    if not split_files:
+        # Write every bucket to a single file in one go
+        bucket_index = np.searchsorted(bucket_ends, timestamps, side='left')
+        print(f"Converting {len(timestamps)} observation(s) and saving as netcdf")
+        writes = [(observations, mission_name, first_bucket, bucket_hours, bucket_index)]
+    else:
+        split_indices = np.searchsorted(timestamps, bucket_ends, side='right')
+
+        writes = []
+        start_index = 0
+        for curtime, end_index in zip(bucket_ends - bucket_seconds, split_indices):
+            if end_index == start_index:
+                continue  # no data in this bucket
+
+            segment = {field: values[start_index:end_index] for field, values in observations.items()}
+            print(f"Converting {end_index - start_index} observation(s) and saving as netcdf")
+            writes.append((segment, mission_name, curtime, bucket_hours))
+            start_index = end_index
+
+    # Each write is the arguments to convert_to_netcdf
+    if writer is None:
+        for write_args in writes:
+            convert_to_netcdf(*write_args)
+        return []
+    return [writer.submit(convert_to_netcdf, *write_args) for write_args in writes]
+
+def init_writer():
+    """
+    Set up a process writing netcdf files. The writer processes already use every CPU between them,
+    so each one gives numexpr a single thread
+    """
+    if ne is not None:
+        ne.set_num_threads(1)
 
 def main():
     """
@@ -160,8 +268,12 @@ def main():
     parser = argparse.ArgumentParser(description="""
     Retrieves WindBorne data and output to netcdf format.
     
-    Files will be broken up into time buckets as specified by the --bucket_hours option, 
-    and the output file names will contain the time at the mid-point of the bucket. For 
+    Observations will be grouped into time buckets as specified by the --bucket_hours option.
+    By default each mission is written to a single file, with a bucket_index coordinate
+    recording which bucket each observation falls in. With --split-files, each bucket is
+    written to its own file instead.
+
+    The output file names will contain the time at the mid-point of the (first) bucket. For
     example, if you are looking to have files centered on say, 00 UTC 29 April, the start time
     should be 3 hours prior to 00 UTC, 21 UTC 28 April.
     """, formatter_class=argparse.RawTextHelpFormatter)
@@ -170,7 +282,11 @@ def main():
                         help='Starting and ending times to retrieve obs.  Format: YYYY-mm-dd_HH:MM '
                              'Ending time is optional, with current time used as default')
     parser.add_argument('-b', '--bucket_hours', type=float, default=6.0,
-                        help='Number of hours of observations to accumulate into a file before opening the next file')
+                        help='Number of hours of observations to group into each time bucket')
+    parser.add_argument('--split-files', action='store_true',
+                        help='Write each time bucket to its own file rather than one file per mission')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of processes writing netcdf files in parallel, defaulting to the number of CPUs')
     args = parser.parse_args()
 
     if (len(args.times) == 1):
@@ -193,37 +309,62 @@ def main():
 
     args = parser.parse_args()
     bucket_hours = args.bucket_hours
+    if not math.isfinite(bucket_hours) or round(bucket_hours * 60 * 60) < 1:
+        print("error processing input args, --bucket_hours must be at least one second")
+        exit(1)
+    if args.workers is not None and args.workers < 1:
+        print("error processing input args, --workers must be at least 1")
+        exit(1)
 
-    observations_by_mission = {}
-    accumulated_observations = []
+    # For each mission, a list of (observations x OBSERVATION_FIELDS) float64 arrays, one per page
+    observations_by_mission = defaultdict(list)
     has_next_page = True
 
     # This line here would just find W-1594, useful for testing/debugging
     #next_page = f"https://sensor-data.windbornesystems.com/api/v1/super_observations.json?mission_id=c8108dd5-bcf5-45ec-be80-a1da5e382e99&min_time={starttime}&max_time={endtime}&include_mission_name=true"
 
-    next_page = f"https://sensor-data.windbornesystems.com/api/v1/super_observations.json?min_time={starttime}&max_time={endtime}&include_mission_name=true"
-
-    while has_next_page:
-        # Note that we query superobservations, which are described here:
-        # https://windbornesystems.com/docs/api#super_observations
-        # We find that for most NWP applications this leads to better performance than overwhelming with high-res data
-        print(next_page)
-        observations_page = wb_get_request(next_page)
-        has_next_page = observations_page["has_next_page"]
-        if (len(observations_page['observations']) == 0):
-            print("Could not find any observations for the input date range!!!!")
-        if has_next_page:
-            next_page = observations_page["next_page"]+"&include_mission_name=true&min_time={}&max_time={}".format(starttime,endtime)
-        print(f"Fetched page with {len(observations_page['observations'])} observation(s)")
-        for observation in observations_page['observations']:
-            if 'mission_name' not in observation:
-                print("got an ob without a mission name???")
-                continue
-            elif observation['mission_name'] not in observations_by_mission:
-                observations_by_mission[observation['mission_name']] = []
-
-            observations_by_mission[observation['mission_name']].append(observation)
-            accumulated_observations.append(observation)
+    # Query parameters set on every page, including the pages the API links to
+    page_params = {'min_time': starttime, 'max_time': endtime, 'include_mission_name': 'true'}
+    next_page = with_query_params("https://sensor-data.windbornesystems.com/api/v1/super_observations.json", page_params)
+
+    # Pages are fetched over one kept-alive connection, one page ahead of the processing
+    session = requests.Session()
+    with ThreadPoolExecutor(max_workers=1) as fetcher:
+        page_future = fetcher.submit(wb_get_request, next_page, session)
+        while has_next_page:
+            # Note that we query superobservations, which are described here:
+            # https://windbornesystems.com/docs/api#super_observations
+            # We find that for most NWP applications this leads to better performance than overwhelming with high-res data
+            print(next_page)
+            observations_page = page_future.result()
+            has_next_page = observations_page["has_next_page"]
+            if (len(observations_page['observations']) == 0):
+                print("Could not find any observations for the input date range!!!!")
+            if has_next_page:
+                next_page = with_query_params(observations_page["next_page"], page_params)
+                # Start fetching the next page while this one is processed
+                page_future = fetcher.submit(wb_get_request, next_page, session)
+            print(f"Fetched page with {len(observations_page['observations'])} observation(s)")
+
+            # Drop observations without a mission name in one pass, so the rest need no per-observation checks
+            page_observations = [observation for observation in observations_page['observations']
+                                 if 'mission_name' in observation]
+            if len(page_observations) < len(observations_page['observations']):
+                print(f"got {len(observations_page['observations']) - len(page_observations)} "
+                      "ob(s) without a mission name???")
+
+            page_missions = [observation['mission_name'] for observation in page_observations]
+            page_rows = [tuple(map(observation.get, OBSERVATION_FIELDS)) for observation in page_observations]
+
+            # Convert the whole page to float64 in a single call, with missing values (None) becoming NaN,
+            #    then hand each mission its rows. A stable sort by mission groups the rows while keeping
+            #    them in page order within each mission
+            page_values = np.array(page_rows, dtype=np.float64).reshape(-1, len(OBSERVATION_FIELDS))
+            missions, mission_index = np.unique(page_missions, return_inverse=True)
+            order = np.argsort(mission_index, kind='stable')
+            mission_rows = np.split(page_values[order], np.cumsum(np.bincount(mission_index))[:-1])
+            for mission_name, rows in zip(missions, mission_rows):
+                observations_by_mission[str(mission_name)].append(rows)
 
             # alternatively, you could call `time.sleep(60)` and keep polling here for real-time data
 
@@ -232,8 +373,18 @@ def main():
         print("No observations found")
         return
 
-    for mission_name, accumulated_observations in observations_by_mission.items():
-        output_data(accumulated_observations, mission_name, starttime, bucket_hours)
+    # The files are independent, so are written in parallel
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_writer) as writer:
+        futures = []
+        for mission_name, page_values in observations_by_mission.items():
+            # Join the pages and lay each field out as its own contiguous array
+            columns = np.concatenate(page_values).T.copy()
+            observations = dict(zip(OBSERVATION_FIELDS, columns))
+            futures += output_data(observations, mission_name, starttime, bucket_hours, args.split_files, writer)
+
+        # Surface any error from writing the files
+        for future in futures:
+            future.result()
 
 if __name__ == '__main__':
     main()